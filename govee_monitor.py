@@ -1,25 +1,93 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import configparser
-import glob
+import logging
+import logging.handlers
 import os
-import re
-import threading
+import queue
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 
-import requests
+import httpx
+import orjson
+from watchfiles import Change, awatch
 
 
+log = logging.getLogger(__name__)
+
 DEFAULT_CONFIG_PATH = "/etc/dankweather-govee-monitor.conf"
 
 DEFAULT_CONFIG = {
     "log_dir": "/var/log/goveebttemplogger/",
     "api_url": "https://api.dankweather.com/log",
     "provision_key": "",
+    "dedupe_interval": "300",
 }
 
+# Bytes pulled per os.read(); a burst of lines is handled in one syscall.
+READ_SIZE = 65536
+
+# Complete lines past this size (e.g. goveebttemplogger appending a sensor's
+# downloaded history) are parsed in a worker thread, keeping the loop free.
+OFFLOAD_SIZE = 32768
+
+# Linux-only: stops tailing from dirtying the log's atime on every read. The
+# kernel only honours it for the file's owner, so open_log falls back.
+O_NOATIME = getattr(os, "O_NOATIME", 0)
+
+
+def setup_logging(level=logging.INFO):
+    """Sends log records through a queue to a dedicated stderr writer thread.
+
+    Tasks on the event loop only enqueue records, so they never block on the
+    stream. Returns the started QueueListener; stop it on exit to flush.
+    """
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(records, handler)
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    # watchfiles logs every change batch and httpx every request at INFO; keep
+    # those out of the journal
+    logging.getLogger("watchfiles").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener.start()
+    return listener
+
+
+def open_log(path):
+    """Opens a log as a raw, non-blocking fd positioned at its end (tail)."""
+    flags = os.O_RDONLY | os.O_NONBLOCK
+    try:
+        fd = os.open(path, flags | O_NOATIME)
+    except PermissionError:
+        # EPERM when we don't own the file (the service runs as nobody)
+        if not O_NOATIME:
+            raise
+        fd = os.open(path, flags)
+    os.lseek(fd, 0, os.SEEK_END)
+    return fd
+
+
+def utc_month(now=None):
+    """Returns the (year, month) of 'now', defaulting to the current UTC time."""
+    if now is None:
+        # struct_time is cheaper than building a datetime just for two fields
+        t = time.gmtime()
+        return t.tm_year, t.tm_mon
+    return now.year, now.month
+
+
+def seconds_until_next_month(now):
+    """Returns the seconds from the aware UTC datetime 'now' to the next month."""
+    year, month = (now.year + 1, 1) if now.month == 12 else (now.year, now.month + 1)
+    return (datetime(year, month, 1, tzinfo=timezone.utc) - now).total_seconds()
+
 
 def load_config(path=DEFAULT_CONFIG_PATH):
     """Load settings from an INI-style config file.
@@ -40,163 +108,455 @@ def load_config(path=DEFAULT_CONFIG_PATH):
         "log_dir": section.get("log_dir"),
         "api_url": section.get("api_url"),
         "provision_key": provision_key,
+        "dedupe_interval": section.getfloat("dedupe_interval"),
     }
 
 
 class GoveeMonitor:
-    def __init__(self, log_dir, api_url, provision_key=None):
-        self.log_dir = log_dir
+    def __init__(self, log_dir, api_url, provision_key=None, dedupe_interval=300.0):
+        self.log_dir = log_dir.rstrip("/") or "/"
         self.api_url = api_url
         self.provision_key = provision_key
-        self.check_interval = 1.0  # Sleep at end of loop
-        self.retry_interval = 1.0  # Sleep on error/missing file
-        self.scan_interval = 60.0
-        self.stop_event = threading.Event()
+        # Seconds an unchanged reading is suppressed before it is re-sent as a
+        # heartbeat; 0 sends every reading.
+        self.dedupe_interval = dedupe_interval
+        self.retry_interval = 1.0  # Sleep on error opening a file
+        self.scan_interval = 60.0  # Retry period while log_dir can't be watched
+        # Longest the month clock sleeps before re-reading the wall clock, so
+        # an NTP step (e.g. a Pi booting without an RTC) is picked up quickly.
+        self.month_check_interval = 3600.0
+        self.batch_max_size = 64  # Records per POST
+        self.batch_max_wait = 0.2  # Seconds to wait for a batch to fill
+        self.send_concurrency = 8  # Sender workers draining send_queue
+        self.send_retries = 5  # Extra attempts for network errors / 429 / 5xx
+        self.retry_backoff = 1.0  # First retry delay; doubles each attempt
+        self.retry_backoff_max = 60.0
+        self.stop_event = asyncio.Event()
         self.monitored_sensors = set()
+        self.file_events = {}  # sensor_id -> asyncio.Event set by the watcher
+        # sensor_id -> (record, its logged datetime) for the last reading that
+        # was queued rather than deduped; the anchor for is_duplicate.
+        self._last_queued = {}
+        self.current_month = utc_month()  # (year, month), kept by month_clock
+        self.tasks = set()  # Strong refs so running tasks aren't GC'd
+        # (sensor_id, record tuple, JSON payload) items. Bounded so a long API
+        # outage sheds readings with a warning instead of growing without limit.
+        self.send_queue = asyncio.Queue(maxsize=10_000)
+        self._collect_lock = asyncio.Lock()  # One worker fills a batch at a time
+        self._hdrs = {"Content-Type": "application/json"}
+        # One pooled client shared by every sensor task, so the TCP/TLS
+        # connection to the API is reused instead of re-handshaking per POST.
+        self.http = httpx.AsyncClient(
+            http2=True,
+            timeout=5.0,
+            limits=httpx.Limits(max_keepalive_connections=32),
+        )
 
     def parse_line(self, line):
-        """Parses a log line into a dictionary. Returns None if invalid."""
-        parts = line.strip().split()
+        """Parses a raw log line (bytes) into a tuple. Returns None if invalid.
+
+        The tuple is (date, time, temperature, humidity, battery), all str.
+        """
+        # A bare split() already drops the trailing newline, so no strip()
+        parts = line.decode("utf-8", "replace").split()
         if len(parts) < 5:
             return None
-
-        return {
-            "date": parts[0],
-            "time": parts[1],
-            "temperature": parts[2],
-            "humidity": parts[3],
-            "battery": parts[4],
-        }
-
-    def send_record(self, sensor_id, record):
-        """Sends a parsed record to the API."""
-        payload = {
+        return tuple(parts[:5])
+
+    def parse_chunk(self, sensor_id, template, data):
+        """Turns a run of complete log lines into send_queue items.
+
+        Safe to run in an executor thread while monitor_loop awaits it: the
+        template and the sensor's _last_queued entry are only used by that task.
+        """
+        items = []
+        for line in data.split(b"\n"):
+            record = self.parse_line(line)
+            if record and not self.is_duplicate(sensor_id, record):
+                items.append((sensor_id, record, self.encode_payload(template, record)))
+        return items
+
+    def payload_template(self, sensor_id):
+        """Builds the reusable payload dict for a sensor's records.
+
+        'id' (and 'provision_key') never change for a sensor, so each record
+        only overwrites the reading fields; see encode_payload.
+        """
+        template = {
             "id": sensor_id,
-            "datetime": f"{record['date']} {record['time']}",
-            "temperature": record["temperature"],
-            "humidity": record["humidity"],
-            "battery": record["battery"],
+            "datetime": None,
+            "temperature": None,
+            "humidity": None,
+            "battery": None,
         }
         if self.provision_key:
-            payload["provision_key"] = self.provision_key
+            template["provision_key"] = self.provision_key
+        return template
+
+    def encode_payload(self, template, record):
+        """Fills 'template' with a parsed record and returns it as JSON bytes.
+
+        The bytes are produced before the template is touched again, so one
+        template can safely serve every record from the same sensor.
+        """
+        date, time_of_day, temperature, humidity, battery = record
+        template["datetime"] = f"{date} {time_of_day}"
+        template["temperature"] = temperature
+        template["humidity"] = humidity
+        template["battery"] = battery
+        return orjson.dumps(template)
+
+    async def send_batch(self, batch):
+        """Sends a list of (sensor_id, record, payload) items in one POST.
+
+        'payload' is the record's JSON from encode_payload. A lone record is
+        sent as that plain reading object; larger batches are wrapped as
+        {"records": [...]}. Network errors and 429/5xx responses are retried
+        with exponential backoff; other errors are not. Returns True once the
+        API accepts the batch, False if it is given up on.
+        """
+        if len(batch) == 1:
+            body = batch[0][2]
+        else:
+            body = b'{"records":[' + b",".join(item[2] for item in batch) + b"]}"
+
+        delay = self.retry_backoff
+        for attempt in range(self.send_retries + 1):
+            if attempt:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_backoff_max)
+            try:
+                response = await self.http.post(
+                    self.api_url, content=body, headers=self._hdrs
+                )
+            except Exception as e:
+                log.error(
+                    "Exception sending data for %s: %s", self._sensor_list(batch), e
+                )
+                continue
 
-        try:
-            response = requests.post(
-                self.api_url,
-                json=payload,
-                timeout=5,
-                headers={"Content-Type": "application/json"},
+            if response.status_code == 200:
+                if log.isEnabledFor(logging.INFO):
+                    for sensor_id, record, _ in batch:
+                        log.info("Sent %s: %s %s", sensor_id, record[0], record[1])
+                return True
+
+            log.error(
+                "Error sending %s: %s - %s",
+                self._sensor_list(batch),
+                response.status_code,
+                response.text,
             )
-            if response.status_code != 200:
-                print(
-                    f"[!] Error sending {sensor_id}: {response.status_code} - {response.text}"
-                )
+            if response.status_code != 429 and response.status_code < 500:
                 return False
-            else:
-                print(f"[+] Sent {sensor_id}: {payload['datetime']}")
+        return False
+
+    def _sensor_list(self, batch):
+        """Sensor IDs in a batch, formatted for error messages."""
+        return ", ".join(sorted({item[0] for item in batch}))
+
+    async def collect_records(self):
+        """Takes the records for one send round off send_queue.
+
+        Blocks for the first record, then drains whatever is already queued
+        without awaiting, up to send_concurrency batches' worth. If that
+        doesn't fill a batch, waits up to batch_max_wait for stragglers.
+        """
+        loop = asyncio.get_running_loop()
+        records = [await self.send_queue.get()]
+        limit = self.batch_max_size * self.send_concurrency
+        deadline = loop.time() + self.batch_max_wait
+        while len(records) < limit:
+            try:
+                records.append(self.send_queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if len(records) >= self.batch_max_size or timeout <= 0:
+                break
+            try:
+                records.append(await asyncio.wait_for(self.send_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return records
+
+    async def sender_worker(self):
+        """Repeatedly collects queued records and sends them.
+
+        Records are collected under a lock so concurrent workers don't split a
+        burst into single-record POSTs. A round holding more than one batch
+        sends its batches concurrently, multiplexed as HTTP/2 streams on the
+        shared connection; sending (and any retry backoff) overlaps between
+        workers.
+        """
+        while not self.stop_event.is_set():
+            async with self._collect_lock:
+                records = await self.collect_records()
+            size = self.batch_max_size
+            batches = [records[i : i + size] for i in range(0, len(records), size)]
+            results = await asyncio.gather(*map(self.send_batch, batches))
+            for batch, sent in zip(batches, results):
+                if not sent:
+                    log.warning("Dropped %d record(s) after failed send", len(batch))
+                    for sensor_id, record, _ in batch:
+                        self.forget_reading(sensor_id, record)
+
+    def is_duplicate(self, sensor_id, record):
+        """True if 'record' repeats the sensor's last queued reading too soon.
+
+        Stable conditions make sensors log the same temperature/humidity/
+        battery over and over; those are skipped until dedupe_interval has
+        passed, when the reading goes out again as a heartbeat. Time is taken
+        from the readings' own timestamps, so a replayed backlog (downloaded
+        history) still keeps one heartbeat per dedupe_interval of logged time.
+        """
+        try:
+            taken = datetime.fromisoformat(f"{record[0]} {record[1]}")
+        except ValueError:
+            return False  # No usable timestamp; always send
+        last = self._last_queued.get(sensor_id)
+        if last and last[0][2:] == record[2:]:
+            if 0 <= (taken - last[1]).total_seconds() < self.dedupe_interval:
                 return True
-        except Exception as e:
-            print(f"[!] Exception sending data for {sensor_id}: {e}")
-            return False
+        self._last_queued[sensor_id] = (record, taken)
+        return False
 
-    def get_log_filename(self, sensor_id, now=None):
-        """Generates the expected filename. 'now' can be injected for testing."""
-        if now is None:
-            now = datetime.utcnow()
-        return os.path.join(
-            self.log_dir, f"gvh-{sensor_id}-{now.year}-{now.month:02d}.txt"
-        )
+    def forget_reading(self, sensor_id, record):
+        """Stops a reading that never reached the API from suppressing repeats."""
+        last = self._last_queued.get(sensor_id)
+        if last and last[0] is record:
+            del self._last_queued[sensor_id]
 
-    def monitor_loop(self, sensor_id):
-        """Worker thread logic for a single sensor."""
-        print(f"[*] Started monitoring thread for: {sensor_id}")
+    def enqueue(self, sensor_id, record, payload):
+        """Queues an encoded record for sending without ever blocking the reader."""
+        try:
+            self.send_queue.put_nowait((sensor_id, record, payload))
+        except asyncio.QueueFull:
+            log.warning("Send queue full, dropping %s: %s %s", sensor_id, *record[:2])
+            self.forget_reading(sensor_id, record)
 
+    def get_log_filename(self, sensor_id, now=None):
+        """Generates the expected filename. 'now' can be injected for testing."""
+        year, month = self.current_month if now is None else utc_month(now)
+        return f"{self.log_dir}/gvh-{sensor_id}-{year}-{month:02d}.txt"
+
+    async def month_clock(self):
+        """Keeps current_month in step with UTC, waking every sensor at rollover."""
+        while True:
+            remaining = seconds_until_next_month(datetime.now(timezone.utc))
+            if not await self.sleep(min(remaining, self.month_check_interval)):
+                return
+
+            month = utc_month()
+            if month != self.current_month:
+                self.current_month = month
+                for event in self.file_events.values():
+                    event.set()
+
+    async def sleep(self, seconds):
+        """Sleeps for 'seconds'. Returns False if stop() cut the sleep short."""
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+    async def wait_for_change(self, sensor_id):
+        """Blocks until one of the sensor's files changes or the monitor stops.
+
+        Returns False once stop() has been called, so callers can exit without
+        polling stop_event.
+        """
+        event = self.file_events[sensor_id]
+        if not event.is_set() and not self.stop_event.is_set():
+            file_task = asyncio.ensure_future(event.wait())
+            stop_task = asyncio.ensure_future(self.stop_event.wait())
+            try:
+                await asyncio.wait(
+                    {file_task, stop_task}, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                file_task.cancel()
+                stop_task.cancel()
+        event.clear()
+        return not self.stop_event.is_set()
+
+    async def monitor_loop(self, sensor_id):
+        """Task logic for a single sensor."""
+        log.info("Started monitoring task for: %s", sensor_id)
+        self.file_events.setdefault(sensor_id, asyncio.Event())
+
+        loop = asyncio.get_running_loop()
+        template = self.payload_template(sensor_id)
+        month = self.current_month
         current_file_path = self.get_log_filename(sensor_id)
-        current_file = None
+        next_file_path = None  # Next month's log, once the month has turned
+        fd = None
+        pending = bytearray()  # Trailing partial line carried between reads
 
-        while not self.stop_event.is_set():
-            # 1. Ensure file is open
-            if current_file is None:
-                if os.path.exists(current_file_path):
-                    try:
-                        current_file = open(current_file_path, "r")
-                        current_file.seek(0, 2)  # Tail
-                        print(f"[*] Tailing: {current_file_path}")
-                    except Exception as e:
-                        print(f"[!] Error opening {current_file_path}: {e}")
-                        time.sleep(self.retry_interval)
+        try:
+            while True:
+                # 1. Ensure file is open
+                if fd is None:
+                    if os.path.exists(current_file_path):
+                        try:
+                            fd = open_log(current_file_path)
+                            log.info("Tailing: %s", current_file_path)
+                        except OSError as e:
+                            log.error("Error opening %s: %s", current_file_path, e)
+                            if not await self.sleep(self.retry_interval):
+                                break
+                            continue
+                    else:
+                        if not await self.wait_for_change(sensor_id):
+                            break
+                        # Re-check filename in case of month rollover while waiting
+                        if self.current_month != month:
+                            month = self.current_month
+                            current_file_path = self.get_log_filename(sensor_id)
                         continue
-                else:
-                    time.sleep(self.retry_interval)
-                    # Re-check filename in case of month rollover while waiting
-                    current_file_path = self.get_log_filename(sensor_id)
-                    continue
 
-            # 2. Read new lines
-            line = current_file.readline()
-            if line:
-                record = self.parse_line(line)
-                if record:
-                    self.send_record(sensor_id, record)
-                continue
+                # 2. Read everything appended since the last wakeup
+                chunk = os.read(fd, READ_SIZE)
+                if chunk:
+                    pending += chunk
+                    end = pending.rfind(b"\n")
+                    if end >= 0:
+                        lines = pending[:end]
+                        del pending[: end + 1]
+                        if end > OFFLOAD_SIZE:
+                            items = await loop.run_in_executor(
+                                None, self.parse_chunk, sensor_id, template, lines
+                            )
+                        else:
+                            items = self.parse_chunk(sensor_id, template, lines)
+                        for item in items:
+                            self.enqueue(*item)
+                    continue
 
-            # 3. Check for Rollover
-            expected_file_path = self.get_log_filename(sensor_id)
-            if expected_file_path != current_file_path:
-                if os.path.exists(expected_file_path):
-                    print(
-                        f"[*] Rollover detected: {current_file_path} -> {expected_file_path}"
+                # 3. Check for Rollover. The new name is built once per month
+                # change; until the logger creates it, wakeups only stat it.
+                if self.current_month != month:
+                    month = self.current_month
+                    next_file_path = self.get_log_filename(sensor_id)
+                if next_file_path and os.path.exists(next_file_path):
+                    log.info(
+                        "Rollover detected: %s -> %s",
+                        current_file_path,
+                        next_file_path,
                     )
-                    current_file.close()
-                    current_file = None
-                    current_file_path = expected_file_path
+                    os.close(fd)
+                    fd = None
+                    pending.clear()
+                    current_file_path = next_file_path
+                    next_file_path = None
                     continue
 
-            # 4. Sleep
-            time.sleep(self.check_interval)
-
-        # Cleanup on exit
-        if current_file:
-            current_file.close()
+                # 4. Wait for the file to grow (or a new one to appear)
+                if not await self.wait_for_change(sensor_id):
+                    break
+        finally:
+            # Cleanup on exit, including cancellation at shutdown
+            if fd is not None:
+                os.close(fd)
+
+    def sensor_id_from_filename(self, filename):
+        """Returns the sensor ID for a gvh-*-YYYY-MM.txt filename, else None."""
+        # Fixed "gvh-" prefix and fixed 12-char "-YYYY-MM.txt" suffix, so plain
+        # slicing is enough; no regex needed.
+        if len(filename) < 17 or not filename.startswith("gvh-"):
+            return None
+        suffix = filename[-12:]
+        if (
+            suffix[0] != "-"
+            or suffix[5] != "-"
+            or suffix[8:] != ".txt"
+            or not suffix[1:5].isdigit()
+            or not suffix[6:8].isdigit()
+        ):
+            return None
+        return filename[4:-12]
 
     def scan_sensors(self):
-        """Scans the directory for sensor files and returns a list of new sensor IDs."""
-        files = glob.glob(os.path.join(self.log_dir, "gvh-*.txt"))
-        new_sensors = []
-
-        for filepath in files:
-            filename = os.path.basename(filepath)
-            match = re.match(r"gvh-(.+)-\d{4}-\d{2}\.txt", filename)
-
-            if match:
-                sensor_id = match.group(1)
-                if sensor_id not in self.monitored_sensors:
-                    new_sensors.append(sensor_id)
-        return new_sensors
-
-    def discovery_loop(self):
-        """Main loop that looks for new sensors."""
-        print("--- Govee Log Monitor Started ---")
-        while not self.stop_event.is_set():
-            new_sensors = self.scan_sensors()
-            for sensor_id in new_sensors:
-                self.monitored_sensors.add(sensor_id)
-                t = threading.Thread(
-                    target=self.monitor_loop, args=(sensor_id,), daemon=True
-                )
-                t.start()
-
-            time.sleep(self.scan_interval)
+        """Returns the set of sensor IDs in log_dir that aren't monitored yet."""
+        with os.scandir(self.log_dir) as entries:
+            found = {self.sensor_id_from_filename(entry.name) for entry in entries}
+        found.discard(None)
+        return found - self.monitored_sensors
+
+    def start_monitor(self, sensor_id):
+        """Starts tailing a newly discovered sensor.
+
+        Only the discovery task calls this, so it alone writes
+        monitored_sensors and no sensor can be spawned twice.
+        """
+        self.monitored_sensors.add(sensor_id)
+        self.file_events[sensor_id] = asyncio.Event()
+        self.spawn(self.monitor_loop(sensor_id))
+
+    def handle_file_event(self, filename):
+        """Routes a directory event to the sensor that owns the file."""
+        sensor_id = self.sensor_id_from_filename(filename)
+        if sensor_id is None:
+            return
+        if sensor_id in self.monitored_sensors:
+            self.file_events[sensor_id].set()
+        else:
+            self.start_monitor(sensor_id)
+
+    async def discovery_loop(self):
+        """Main loop: watches log_dir and wakes sensor tasks on file changes."""
+        log.info("--- Govee Log Monitor Started ---")
+        for _ in range(self.send_concurrency):
+            self.spawn(self.sender_worker())
+        self.spawn(self.month_clock())
+        while not os.path.isdir(self.log_dir):
+            log.warning("Cannot watch %s: directory does not exist", self.log_dir)
+            if not await self.sleep(self.scan_interval):
+                return
+
+        # Bootstrap from what's already on disk. A file created before the
+        # watcher is up is still picked up on its next write.
+        for sensor_id in sorted(self.scan_sensors()):
+            self.start_monitor(sensor_id)
+
+        async for changes in awatch(
+            self.log_dir,
+            watch_filter=None,
+            recursive=False,
+            stop_event=self.stop_event,
+        ):
+            for change, path in changes:
+                if change != Change.deleted:
+                    self.handle_file_event(os.path.basename(path))
+
+    def spawn(self, coro):
+        """Starts a background task, holding a reference until it finishes."""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def run(self):
+        """Runs the discovery loop, then tears down its tasks and HTTP client."""
+        try:
+            await self.discovery_loop()
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.http.aclose()
 
     def start(self):
-        """Starts the discovery loop."""
+        """Runs the monitor on a fresh event loop."""
         try:
-            self.discovery_loop()
+            asyncio.run(self.run())
         except KeyboardInterrupt:
             self.stop()
 
     def stop(self):
-        """Signals all threads to stop."""
+        """Signals all tasks to stop."""
         self.stop_event.set()
 
 
@@ -210,9 +570,13 @@ def main():
     )
     args = parser.parse_args()
 
-    config = load_config(args.config)
-    monitor = GoveeMonitor(**config)
-    monitor.start()
+    listener = setup_logging()
+    try:
+        config = load_config(args.config)
+        monitor = GoveeMonitor(**config)
+        monitor.start()
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
@@ -1,31 +1,91 @@
+import asyncio
+import io
+import logging
 import os
+import shutil
 import tempfile
+import threading
 import unittest
-from datetime import datetime
-from unittest.mock import MagicMock, mock_open, patch
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
 
-from govee_monitor import DEFAULT_CONFIG, GoveeMonitor, load_config
+import orjson
+from watchfiles import Change
 
+from govee_monitor import (
+    DEFAULT_CONFIG,
+    O_NOATIME,
+    OFFLOAD_SIZE,
+    GoveeMonitor,
+    load_config,
+    open_log,
+    seconds_until_next_month,
+    setup_logging,
+    utc_month,
+)
 
-class TestGoveeMonitor(unittest.TestCase):
+
+def fake_awatch(*batches):
+    """Stands in for watchfiles.awatch, replaying fixed batches of changes."""
+    calls = []
+
+    async def awatch(*paths, **kwargs):
+        calls.append((paths, kwargs))
+        for changes in batches:
+            yield changes
+
+    awatch.calls = calls
+    return awatch
+
+
+class TestGoveeMonitor(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
         self.log_dir = "/tmp/logs"
         self.api_url = "http://test.com/api"
         self.monitor = GoveeMonitor(self.log_dir, self.api_url)
         # Ensure intervals are small, though we will mock sleep anyway
-        self.monitor.check_interval = 0.01
         self.monitor.scan_interval = 0.01
         self.monitor.retry_interval = 0.01
+        self.monitor.retry_backoff = 0
+
+    def item(self, sensor_id, record, monitor=None):
+        """A send_queue item as monitor_loop would build it."""
+        monitor = monitor or self.monitor
+        template = monitor.payload_template(sensor_id)
+        return (sensor_id, record, monitor.encode_payload(template, record))
 
     def test_parse_line_valid(self):
-        line = "2023-10-27 10:00:00 22.5 45 88"
+        line = b"2023-10-27 10:00:00\t22.5\t45\t88\n"
         result = self.monitor.parse_line(line)
-        self.assertEqual(result["date"], "2023-10-27")
-        self.assertEqual(result["temperature"], "22.5")
+        self.assertEqual(result, ("2023-10-27", "10:00:00", "22.5", "45", "88"))
+
+    def test_encode_payload(self):
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+        payload = self.monitor.encode_payload(
+            self.monitor.payload_template("SENS1"), record
+        )
+        self.assertEqual(
+            orjson.loads(payload),
+            {
+                "id": "SENS1",
+                "datetime": "2023-01-01 12:00",
+                "temperature": "20",
+                "humidity": "50",
+                "battery": "100",
+            },
+        )
+
+    def test_encode_payload_reuses_template(self):
+        template = self.monitor.payload_template("SENS1")
+        first = self.monitor.encode_payload(template, ("d1", "t1", "20", "50", "99"))
+        second = self.monitor.encode_payload(template, ("d2", "t2", "21", "51", "98"))
+        self.assertEqual(orjson.loads(first)["datetime"], "d1 t1")
+        self.assertEqual(orjson.loads(second)["datetime"], "d2 t2")
+        self.assertEqual(orjson.loads(second)["battery"], "98")
 
     def test_parse_line_invalid(self):
-        line = "2023-10-27 10:00:00"  # Too short
+        line = b"2023-10-27 10:00:00"  # Too short
         result = self.monitor.parse_line(line)
         self.assertIsNone(result)
 
@@ -36,233 +96,635 @@ class TestGoveeMonitor(unittest.TestCase):
         self.assertEqual(filename, expected)
         self.assertTrue(self.monitor.get_log_filename("A1").startswith(self.log_dir))
 
-    @patch("requests.post")
-    def test_send_record_success(self, mock_post):
+    def test_get_log_filename_trailing_slash(self):
+        monitor = GoveeMonitor(self.log_dir + "/", self.api_url)
+        filename = monitor.get_log_filename("A1", now=datetime(2023, 5, 15))
+        self.assertEqual(filename, "/tmp/logs/gvh-A1-2023-05.txt")
+
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_send_batch_success(self, mock_post):
         mock_post.return_value.status_code = 200
-        record = {
-            "date": "2023-01-01",
-            "time": "12:00",
-            "temperature": "20",
-            "humidity": "50",
-            "battery": "100",
-        }
-        success = self.monitor.send_record("SENS1", record)
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+        success = await self.monitor.send_batch([self.item("SENS1", record)])
         self.assertTrue(success)
         mock_post.assert_called_once()
         args, kwargs = mock_post.call_args
-        self.assertEqual(kwargs["json"]["id"], "SENS1")
+        self.assertEqual(orjson.loads(kwargs["content"])["id"], "SENS1")
 
-    @patch("requests.post")
-    def test_send_record_api_error(self, mock_post):
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_send_batch_api_error(self, mock_post):
         mock_post.return_value.status_code = 500
         mock_post.return_value.text = "Server Error"
-        record = {
-            "date": "2023-01-01",
-            "time": "12:00",
-            "temperature": "20",
-            "humidity": "50",
-            "battery": "100",
-        }
-        success = self.monitor.send_record("SENS1", record)
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+        with self.assertLogs("govee_monitor", level="ERROR") as logs:
+            success = await self.monitor.send_batch([self.item("SENS1", record)])
+        self.assertFalse(success)
+        self.assertIn("Error sending SENS1: 500 - Server Error", logs.output[0])
+        # 5xx is transient, so every retry is used up before giving up
+        self.assertEqual(mock_post.await_count, self.monitor.send_retries + 1)
+
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_send_batch_client_error_not_retried(self, mock_post):
+        mock_post.return_value.status_code = 400
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+        success = await self.monitor.send_batch([self.item("SENS1", record)])
         self.assertFalse(success)
+        mock_post.assert_awaited_once()
 
-    @patch("requests.post")
-    def test_send_record_exception(self, mock_post):
+    @patch("govee_monitor.asyncio.sleep", new_callable=AsyncMock)
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_send_batch_retries_with_backoff(self, mock_post, mock_sleep):
+        self.monitor.retry_backoff = 1.0
+        self.monitor.retry_backoff_max = 3.0
+        ok = MagicMock(status_code=200)
+        mock_post.side_effect = [Exception("Connection error")] * 3 + [ok]
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+
+        success = await self.monitor.send_batch([self.item("SENS1", record)])
+
+        self.assertTrue(success)
+        self.assertEqual(mock_post.await_count, 4)
+        delays = [c.args[0] for c in mock_sleep.await_args_list]
+        self.assertEqual(delays, [1.0, 2.0, 3.0])
+
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_send_batch_exception(self, mock_post):
         mock_post.side_effect = Exception("Connection error")
-        record = {
-            "date": "2023-01-01",
-            "time": "12:00",
-            "temperature": "20",
-            "humidity": "50",
-            "battery": "100",
-        }
-        success = self.monitor.send_record("SENS1", record)
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+        success = await self.monitor.send_batch([self.item("SENS1", record)])
         self.assertFalse(success)
+        self.assertEqual(mock_post.await_count, self.monitor.send_retries + 1)
 
-    @patch("requests.post")
-    def test_send_record_includes_provision_key_when_set(self, mock_post):
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_send_batch_includes_provision_key_when_set(self, mock_post):
         mock_post.return_value.status_code = 200
         monitor = GoveeMonitor(
             self.log_dir, self.api_url, provision_key="prov-abc-123"
         )
-        record = {
-            "date": "2023-01-01",
-            "time": "12:00",
-            "temperature": "20",
-            "humidity": "50",
-            "battery": "100",
-        }
-        monitor.send_record("SENS1", record)
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+        await monitor.send_batch([self.item("SENS1", record, monitor)])
         args, kwargs = mock_post.call_args
-        self.assertEqual(kwargs["json"]["provision_key"], "prov-abc-123")
+        body = orjson.loads(kwargs["content"])
+        self.assertEqual(body["provision_key"], "prov-abc-123")
 
-    @patch("requests.post")
-    def test_send_record_omits_provision_key_when_unset(self, mock_post):
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_send_batch_omits_provision_key_when_unset(self, mock_post):
         mock_post.return_value.status_code = 200
-        record = {
-            "date": "2023-01-01",
-            "time": "12:00",
-            "temperature": "20",
-            "humidity": "50",
-            "battery": "100",
-        }
-        self.monitor.send_record("SENS1", record)
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+        await self.monitor.send_batch([self.item("SENS1", record)])
         args, kwargs = mock_post.call_args
-        self.assertNotIn("provision_key", kwargs["json"])
-
-    @patch("glob.glob")
-    def test_scan_sensors(self, mock_glob):
-        mock_glob.return_value = [
-            "/tmp/logs/gvh-A111-2023-10.txt",
-            "/tmp/logs/gvh-B222-2023-10.txt",
-            "/tmp/logs/readme.txt",
-        ]
-        new = self.monitor.scan_sensors()
-        self.assertIn("A111", new)
-        self.assertIn("B222", new)
-        self.assertEqual(len(new), 2)
+        self.assertNotIn("provision_key", orjson.loads(kwargs["content"]))
 
-        self.monitor.monitored_sensors.update(new)
-        new_again = self.monitor.scan_sensors()
-        self.assertEqual(new_again, [])
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_send_batch_wraps_multiple_records(self, mock_post):
+        mock_post.return_value.status_code = 200
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+        success = await self.monitor.send_batch(
+            [self.item("S1", record), self.item("S2", record)]
+        )
+        self.assertTrue(success)
+        mock_post.assert_called_once()
+        args, kwargs = mock_post.call_args
+        records = orjson.loads(kwargs["content"])["records"]
+        self.assertEqual([r["id"] for r in records], ["S1", "S2"])
+
+    @patch("govee_monitor.GoveeMonitor.send_batch", new_callable=AsyncMock)
+    async def test_sender_worker_batches_queued_records(self, mock_send):
+        self.monitor.batch_max_size = 2
+        for i in range(3):
+            self.monitor.send_queue.put_nowait((f"S{i}", {}))
+
+        # All three are drained in one round and split into two batches that
+        # are sent together; stop once the second (partial) one has gone out
+        def send_effect(batch):
+            if mock_send.await_count >= 2:
+                self.monitor.stop()
+            return True
+
+        mock_send.side_effect = send_effect
+
+        await self.monitor.sender_worker()
+
+        batches = [c.args[0] for c in mock_send.await_args_list]
+        self.assertEqual(batches, [[("S0", {}), ("S1", {})], [("S2", {})]])
+
+    async def test_collect_records_drains_up_to_limit(self):
+        self.monitor.batch_max_size = 2
+        self.monitor.send_concurrency = 2
+        for i in range(5):
+            self.monitor.send_queue.put_nowait((f"S{i}", ()))
+
+        # Everything already queued is taken without waiting, up to
+        # send_concurrency batches' worth
+        records = await self.monitor.collect_records()
+
+        self.assertEqual([r[0] for r in records], ["S0", "S1", "S2", "S3"])
+        self.assertEqual(self.monitor.send_queue.qsize(), 1)
+
+    @patch("govee_monitor.GoveeMonitor.send_batch", new_callable=AsyncMock)
+    async def test_sender_workers_share_batches(self, mock_send):
+        # Several workers waiting at once must not split a burst apart
+        mock_send.return_value = True
+        workers = [asyncio.create_task(self.monitor.sender_worker()) for _ in range(3)]
+        for i in range(3):
+            self.monitor.enqueue(f"S{i}", ("2023-01-01", "12:00"), b"{}")
+            await asyncio.sleep(0)
+
+        await asyncio.sleep(self.monitor.batch_max_wait * 2)
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        mock_send.assert_awaited_once()
+        self.assertEqual(len(mock_send.await_args.args[0]), 3)
+
+    def test_enqueue_drops_when_queue_full(self):
+        self.monitor.send_queue = asyncio.Queue(maxsize=1)
+        record = ("2023-01-01", "12:00", "20", "50", "100")
+        self.monitor.enqueue(*self.item("S1", record))
+        with self.assertLogs("govee_monitor", level="WARNING") as logs:
+            self.monitor.enqueue(*self.item("S2", record))
+        self.assertIn("dropping S2: 2023-01-01 12:00", logs.output[0])
+        self.assertEqual(self.monitor.send_queue.qsize(), 1)
+
+    def test_is_duplicate_suppresses_repeats_until_heartbeat(self):
+        self.monitor.dedupe_interval = 300
+        reading = ("2023-01-01", "12:00:00", "20", "50", "100")
+        self.assertFalse(self.monitor.is_duplicate("S1", reading))
+
+        # Same values logged a minute later are skipped...
+        repeat = ("2023-01-01", "12:01:00", "20", "50", "100")
+        self.assertTrue(self.monitor.is_duplicate("S1", repeat))
+        # ...but a changed value, another sensor, or the heartbeat goes out
+        self.assertFalse(self.monitor.is_duplicate("S2", reading))
+        changed = ("2023-01-01", "12:02:00", "21", "50", "100")
+        self.assertFalse(self.monitor.is_duplicate("S1", changed))
+        later = ("2023-01-01", "12:06:59", "21", "50", "100")
+        self.assertTrue(self.monitor.is_duplicate("S1", later))
+        heartbeat = ("2023-01-01", "12:07:00", "21", "50", "100")
+        self.assertFalse(self.monitor.is_duplicate("S1", heartbeat))
+
+    def test_is_duplicate_disabled_with_zero_interval(self):
+        self.monitor.dedupe_interval = 0
+        reading = ("2023-01-01", "12:00", "20", "50", "100")
+        self.assertFalse(self.monitor.is_duplicate("S1", reading))
+        self.assertFalse(self.monitor.is_duplicate("S1", reading))
+
+    def test_is_duplicate_sends_unparseable_timestamps(self):
+        reading = ("someday", "noon", "20", "50", "100")
+        self.assertFalse(self.monitor.is_duplicate("S1", reading))
+        self.assertFalse(self.monitor.is_duplicate("S1", reading))
+
+    def test_stable_backlog_keeps_heartbeats(self):
+        # 28 days of hourly history with unchanged values, appended at once
+        self.monitor.dedupe_interval = 6 * 3600
+        data = b"\n".join(
+            b"2023-02-%02d %02d:00:00 20 50 100" % (1 + hour // 24, hour % 24)
+            for hour in range(28 * 24)
+        )
+        template = self.monitor.payload_template("S1")
+        items = self.monitor.parse_chunk("S1", template, data)
+        # One heartbeat every six hours of logged time
+        self.assertEqual(len(items), 28 * 4)
+        self.assertEqual(
+            [item[1][1] for item in items[:5]],
+            ["00:00:00", "06:00:00", "12:00:00", "18:00:00", "00:00:00"],
+        )
 
-    @patch("govee_monitor.time.sleep")
-    @patch("govee_monitor.GoveeMonitor.scan_sensors")
-    @patch("threading.Thread")
-    def test_discovery_loop(self, mock_thread, mock_scan, mock_sleep):
-        # 1. First call: returns "S1"
-        # 2. Second call: we force the loop to stop by checking stop_event or raising exception?
-        # A clean way is to make scan_sensors trigger the stop event after returning data.
-        def side_effect():
-            if not self.monitor.monitored_sensors:  # First run
-                return ["S1"]
-            else:
-                self.monitor.stop()  # Stop the loop
-                return []
+    def test_dropped_reading_does_not_suppress_repeats(self):
+        self.monitor.send_queue = asyncio.Queue(maxsize=1)
+        self.monitor.enqueue(*self.item("S0", ("2023-01-01", "11:59", "", "", "")))
+        reading = ("2023-01-01", "12:00", "20", "50", "100")
+        self.assertFalse(self.monitor.is_duplicate("S1", reading))
+        with self.assertLogs("govee_monitor", level="WARNING"):
+            self.monitor.enqueue(*self.item("S1", reading))
+        repeat = ("2023-01-01", "12:01", "20", "50", "100")
+        self.assertFalse(self.monitor.is_duplicate("S1", repeat))
+
+    @patch("govee_monitor.GoveeMonitor.send_batch", new_callable=AsyncMock)
+    async def test_failed_send_does_not_suppress_repeats(self, mock_send):
+        reading = ("2023-01-01", "12:00", "20", "50", "100")
+        self.assertFalse(self.monitor.is_duplicate("S1", reading))
+        self.monitor.enqueue(*self.item("S1", reading))
+
+        def send_effect(batch):
+            self.monitor.stop()
+            return False
 
-        mock_scan.side_effect = side_effect
+        mock_send.side_effect = send_effect
+        with self.assertLogs("govee_monitor", level="WARNING"):
+            await self.monitor.sender_worker()
 
-        # We don't need a separate thread because we've mocked sleep and the exit condition.
-        # But discovery_loop catches KeyboardInterrupt? No, start() does.
-        # We can just run it directly.
-        self.monitor.discovery_loop()
+        repeat = ("2023-01-01", "12:01", "20", "50", "100")
+        self.assertFalse(self.monitor.is_duplicate("S1", repeat))
 
-        self.assertTrue(mock_thread.called)
-        self.assertIn("S1", self.monitor.monitored_sensors)
+    def test_sensor_id_from_filename(self):
+        self.assertEqual(
+            self.monitor.sensor_id_from_filename("gvh-A4C1-2023-10.txt"), "A4C1"
+        )
+        self.assertIsNone(self.monitor.sensor_id_from_filename("readme.txt"))
+        self.assertIsNone(self.monitor.sensor_id_from_filename("gvh-2023-10.txt"))
+        self.assertIsNone(
+            self.monitor.sensor_id_from_filename("gvh-A4C1-2023-1x.txt")
+        )
+        # Anchored at both ends, so backups/temp copies aren't picked up
+        self.assertIsNone(
+            self.monitor.sensor_id_from_filename("gvh-A4C1-2023-10.txt.bak")
+        )
 
-    @patch("govee_monitor.time.sleep")
-    @patch("os.path.exists")
-    @patch("builtins.open", new_callable=mock_open)
-    @patch("govee_monitor.GoveeMonitor.send_record")
-    def test_monitor_loop_flow(self, mock_send, mock_file, mock_exists, mock_sleep):
+    def test_scan_sensors(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        for name in [
+            "gvh-A111-2023-10.txt",
+            "gvh-A111-2023-11.txt",
+            "gvh-B222-2023-10.txt",
+            "readme.txt",
+        ]:
+            open(os.path.join(log_dir, name), "w").close()
+        self.monitor.log_dir = log_dir
+
+        new = self.monitor.scan_sensors()
+        self.assertEqual(new, {"A111", "B222"})
+
+        self.monitor.monitored_sensors.add("A111")
+        self.assertEqual(self.monitor.scan_sensors(), {"B222"})
+
+    @patch("os.path.isdir", return_value=True)
+    @patch("govee_monitor.GoveeMonitor.scan_sensors")
+    @patch("govee_monitor.GoveeMonitor.monitor_loop", new_callable=AsyncMock)
+    async def test_discovery_loop(self, mock_monitor, mock_scan, mock_isdir):
+        # Initial scan finds S1; the watcher then reports a write to S1, a new
+        # S2 file, an unrelated file, and a deleted S3 file.
+        mock_scan.return_value = {"S1"}
+        awatch = fake_awatch(
+            {
+                (Change.modified, "/tmp/logs/gvh-S1-2023-10.txt"),
+                (Change.added, "/tmp/logs/gvh-S2-2023-10.txt"),
+            },
+            {
+                (Change.added, "/tmp/logs/readme.txt"),
+                (Change.deleted, "/tmp/logs/gvh-S3-2023-09.txt"),
+            },
+        )
+
+        with patch("govee_monitor.awatch", awatch):
+            # The fake runs out of changes, which ends the loop.
+            # discovery_loop doesn't catch KeyboardInterrupt; start() does.
+            await self.monitor.discovery_loop()
+
+        paths, kwargs = awatch.calls[0]
+        self.assertEqual(paths, (self.log_dir,))
+        self.assertIs(kwargs["stop_event"], self.monitor.stop_event)
+        self.assertEqual(
+            [c.args for c in mock_monitor.call_args_list], [("S1",), ("S2",)]
+        )
+        # senders, clock, 2 monitors
+        self.assertEqual(len(self.monitor.tasks), self.monitor.send_concurrency + 3)
+        self.assertEqual(self.monitor.monitored_sensors, {"S1", "S2"})
+        self.assertTrue(self.monitor.file_events["S1"].is_set())
+        self.assertFalse(self.monitor.file_events["S2"].is_set())
+
+    @patch("govee_monitor.GoveeMonitor.sleep", new_callable=AsyncMock)
+    @patch("os.path.isdir", side_effect=[False, True])
+    @patch("govee_monitor.GoveeMonitor.scan_sensors", return_value=set())
+    async def test_discovery_loop_waits_for_log_dir(
+        self, mock_scan, mock_isdir, mock_sleep
+    ):
+        mock_sleep.return_value = True
+        awatch = fake_awatch()
+
+        with patch("govee_monitor.awatch", awatch):
+            await self.monitor.discovery_loop()
+
+        mock_sleep.assert_awaited_once_with(self.monitor.scan_interval)
+        self.assertEqual(len(awatch.calls), 1)
+
+    async def test_wait_for_change(self):
+        event = self.monitor.file_events["S1"] = asyncio.Event()
+        event.set()
+        self.assertTrue(await self.monitor.wait_for_change("S1"))
+        self.assertFalse(event.is_set())
+
+    async def test_wait_for_change_returns_false_on_stop(self):
+        self.monitor.file_events["S1"] = asyncio.Event()
+        waiter = asyncio.create_task(self.monitor.wait_for_change("S1"))
+        await asyncio.sleep(0)
+        self.monitor.stop()
+        self.assertFalse(await asyncio.wait_for(waiter, 1))
+
+    async def test_sleep(self):
+        self.assertTrue(await self.monitor.sleep(0))
+        self.monitor.stop()
+        # Returns immediately rather than waiting out the full interval
+        self.assertFalse(await asyncio.wait_for(self.monitor.sleep(60), 1))
+
+    @patch("govee_monitor.GoveeMonitor.discovery_loop", new_callable=AsyncMock)
+    async def test_run_closes_http_client(self, mock_discovery):
+        mock_discovery.side_effect = RuntimeError("Boom")
+        with self.assertRaises(RuntimeError):
+            await self.monitor.run()
+        self.assertTrue(self.monitor.http.is_closed)
+
+    def make_log_dir(self):
+        """Points the monitor at a fresh temp dir; returns a helper to append."""
+        self.monitor.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.monitor.log_dir)
+
+        def append(sensor_id, data, month=None):
+            path = self.monitor.get_log_filename(
+                sensor_id, now=datetime(*month, 1) if month else None
+            )
+            with open(path, "ab") as f:
+                f.write(data)
+            return path
+
+        return append
+
+    @patch("govee_monitor.GoveeMonitor.wait_for_change", new_callable=AsyncMock)
+    async def test_monitor_loop_flow(self, mock_wait):
         sensor_id = "TEST_SENS"
-        mock_exists.return_value = True
+        append = self.make_log_dir()
+        append(sensor_id, b"2023-01-01 11:59 19 49 100\n")  # Before we tail
 
         # Define lifecycle:
-        # 1. Open file (success)
-        # 2. Read line (success) -> send
-        # 3. Read line (empty) -> loop -> sleep -> STOP
+        # 1. Open file (success), seek to end
+        # 2. Wait for change -> a line is appended
+        # 3. Read line (success) -> queue for sending
+        # 4. Read (empty) -> wait for change -> STOP
+        def wait_effect(sensor_id):
+            if mock_wait.await_count == 1:
+                append(sensor_id, b"2023-01-01 12:00 20 50 100\n")
+            else:
+                self.monitor.stop()
+            return not self.monitor.stop_event.is_set()
 
-        handle = mock_file.return_value
-        handle.readline.side_effect = ["2023-01-01 12:00 20 50 100\n", None]
+        mock_wait.side_effect = wait_effect
 
-        # When sleep is called (end of loop), we stop the loop to prevent infinite run
-        def sleep_effect(seconds):
-            self.monitor.stop()
+        await self.monitor.monitor_loop(sensor_id)
 
-        mock_sleep.side_effect = sleep_effect
+        sensor, record, payload = self.monitor.send_queue.get_nowait()
+        self.assertEqual(sensor, sensor_id)
+        self.assertEqual(record[2], "20")
+        self.assertEqual(orjson.loads(payload)["id"], sensor_id)
+        self.assertTrue(self.monitor.send_queue.empty())
 
-        self.monitor.monitor_loop(sensor_id)
+    @patch("govee_monitor.GoveeMonitor.wait_for_change", new_callable=AsyncMock)
+    async def test_monitor_loop_carries_partial_lines(self, mock_wait):
+        append = self.make_log_dir()
+        append("PART", b"")
 
-        mock_file.assert_called()
-        mock_send.assert_called_once()
+        # The logger's write lands in two pieces, then a burst of two lines
+        writes = [
+            b"2023-01-01 12:00 20",
+            b" 50 100\n2023-01-01 12:01 21 51 100\n2023-01-01 12:02 22 52 100\n",
+        ]
 
-    @patch("govee_monitor.time.sleep")
-    @patch("os.path.exists")
-    @patch("builtins.open", new_callable=mock_open)
-    def test_monitor_loop_file_not_found_initially(
-        self, mock_file, mock_exists, mock_sleep
-    ):
-        """Test waiting for file to appear."""
-        # 1. exists -> False (Missing) -> sleep (retry)
-        # 2. exists -> True (Found) -> open -> sleep (end of loop) -> STOP
-        mock_exists.side_effect = [False, True, True]
+        def wait_effect(sensor_id):
+            if writes:
+                append(sensor_id, writes.pop(0))
+            else:
+                self.monitor.stop()
+            return not self.monitor.stop_event.is_set()
+
+        mock_wait.side_effect = wait_effect
 
-        # We use a counter to decide when to stop the loop via sleep side effect
-        # Call 1: Retry sleep (do nothing)
-        # Call 2: Loop interval sleep (Stop)
+        await self.monitor.monitor_loop("PART")
 
-        call_count = 0
+        temps = []
+        while not self.monitor.send_queue.empty():
+            temps.append(self.monitor.send_queue.get_nowait()[1][2])
+        self.assertEqual(temps, ["20", "21", "22"])
 
-        def sleep_logic(seconds):
-            nonlocal call_count
-            call_count += 1
-            if call_count >= 2:
+    @patch("govee_monitor.GoveeMonitor.wait_for_change", new_callable=AsyncMock)
+    async def test_monitor_loop_parses_backlog_off_loop(self, mock_wait):
+        append = self.make_log_dir()
+        append("BULK", b"")
+        backlog = b"".join(
+            b"2023-01-01 %05d %d 50 100\n" % (i, i) for i in range(2000)
+        )
+        self.assertGreater(len(backlog), OFFLOAD_SIZE)
+
+        def wait_effect(sensor_id):
+            if mock_wait.await_count == 1:
+                append(sensor_id, backlog)
+            else:
                 self.monitor.stop()
+            return not self.monitor.stop_event.is_set()
+
+        mock_wait.side_effect = wait_effect
+        threads = []
+        parse_chunk = self.monitor.parse_chunk
+
+        def record_thread(*args):
+            threads.append(threading.get_ident())
+            return parse_chunk(*args)
+
+        with patch.object(self.monitor, "parse_chunk", side_effect=record_thread):
+            await self.monitor.monitor_loop("BULK")
+
+        self.assertTrue(threads)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(self.monitor.send_queue.qsize(), 2000)
+
+    def test_parse_chunk_skips_bad_and_duplicate_lines(self):
+        template = self.monitor.payload_template("S1")
+        data = (
+            b"2023-01-01 12:00 20 50 100\n"
+            b"garbage\n"
+            b"2023-01-01 12:01 20 50 100\n"
+            b"2023-01-01 12:02 21 50 100"
+        )
+        items = self.monitor.parse_chunk("S1", template, data)
+        self.assertEqual([item[1][1] for item in items], ["12:00", "12:02"])
+        self.assertEqual(orjson.loads(items[1][2])["temperature"], "21")
 
-        mock_sleep.side_effect = sleep_logic
+    @patch("govee_monitor.GoveeMonitor.wait_for_change", new_callable=AsyncMock)
+    async def test_monitor_loop_file_not_found_initially(self, mock_wait):
+        """Test waiting for file to appear."""
+        append = self.make_log_dir()
 
-        self.monitor.monitor_loop("S2")
+        # 1. File missing -> wait for it to be created (we create it)
+        # 2. File found -> open -> wait (end of loop) -> STOP
+        def wait_logic(sensor_id):
+            if mock_wait.await_count == 1:
+                append(sensor_id, b"")
+            else:
+                self.monitor.stop()
+            return not self.monitor.stop_event.is_set()
+
+        mock_wait.side_effect = wait_logic
+
+        with patch("os.open", wraps=os.open) as spy_open:
+            await self.monitor.monitor_loop("S2")
 
         # Verify open was eventually called
-        self.assertTrue(mock_file.called)
+        spy_open.assert_called_once()
+        self.assertEqual(mock_wait.await_count, 2)
 
-    @patch("govee_monitor.time.sleep")
+    @patch("govee_monitor.GoveeMonitor.sleep", new_callable=AsyncMock)
     @patch("os.path.exists")
-    @patch("builtins.open", new_callable=mock_open)
-    def test_monitor_loop_open_exception(self, mock_file, mock_exists, mock_sleep):
+    @patch("os.open")
+    async def test_monitor_loop_open_exception(
+        self, mock_os_open, mock_exists, mock_sleep
+    ):
         mock_exists.return_value = True
-        mock_file.side_effect = PermissionError("Boom")
+        mock_os_open.side_effect = PermissionError("Boom")
 
-        # 1. Open -> Exception -> Sleep(retry) -> STOP
-        mock_sleep.side_effect = lambda x: self.monitor.stop()
+        # 1. Open -> Exception -> Sleep(retry) -> interrupted by stop()
+        mock_sleep.return_value = False
 
-        self.monitor.monitor_loop("S3")
+        await self.monitor.monitor_loop("S3")
 
-        self.assertTrue(mock_file.called)
+        self.assertTrue(mock_os_open.called)
+        mock_sleep.assert_awaited_once_with(self.monitor.retry_interval)
 
-    @patch("govee_monitor.time.sleep")
-    @patch("govee_monitor.GoveeMonitor.get_log_filename")
-    @patch("os.path.exists")
-    @patch("builtins.open", new_callable=mock_open)
-    def test_monitor_loop_rollover(
-        self, mock_file, mock_exists, mock_get_filename, mock_sleep
-    ):
-        sensor_id = "ROLL"
-        old_file = "/tmp/logs/gvh-ROLL-2023-01.txt"
-        new_file = "/tmp/logs/gvh-ROLL-2023-02.txt"
-
-        mock_get_filename.side_effect = [
-            old_file,
-            old_file,
-            new_file,
-            new_file,
-            new_file,
-        ]
-        mock_exists.return_value = True
+    def test_open_log_tails_and_falls_back_without_noatime(self):
+        append = self.make_log_dir()
+        path = append("S4", b"old line\n")
+        real_open = os.open
+        flags_seen = []
 
-        # Stop after a few loops
-        mock_sleep.side_effect = lambda x: (
-            self.monitor.stop() if mock_file.return_value.close.called else None
-        )
+        def fake_open(path, flags):
+            flags_seen.append(flags)
+            if flags & O_NOATIME:
+                raise PermissionError("Operation not permitted")
+            return real_open(path, flags)
+
+        with patch("os.open", side_effect=fake_open):
+            fd = open_log(path)
+        self.addCleanup(os.close, fd)
 
-        # Safety break if logic fails
-        loop_limit = 0
-        original_sleep = mock_sleep.side_effect
+        self.assertEqual(os.read(fd, 100), b"")  # Positioned at the end
+        self.assertFalse(flags_seen[-1] & os.O_ACCMODE)  # Read-only
+        self.assertTrue(flags_seen[-1] & os.O_NONBLOCK)
+        if O_NOATIME:
+            self.assertEqual(len(flags_seen), 2)
 
-        def safety_wrapper(x):
-            nonlocal loop_limit
-            loop_limit += 1
-            if loop_limit > 5:
+    @patch("govee_monitor.GoveeMonitor.wait_for_change", new_callable=AsyncMock)
+    async def test_monitor_loop_rollover(self, mock_wait):
+        sensor_id = "ROLL"
+        append = self.make_log_dir()
+        self.monitor.current_month = (2023, 1)
+        append(sensor_id, b"", month=(2023, 1))
+
+        # While we wait, the last January line lands, the month clock ticks
+        # over and February's file appears holding the first new reading.
+        def wait_effect(sensor_id):
+            if mock_wait.await_count == 1:
+                append(sensor_id, b"2023-01-31 23:59 20 50 100\n", month=(2023, 1))
+                append(sensor_id, b"", month=(2023, 2))
+                self.monitor.current_month = (2023, 2)
+            elif mock_wait.await_count == 2:
+                append(sensor_id, b"2023-02-01 00:00 21 50 100\n", month=(2023, 2))
+            else:
+                self.monitor.stop()
+            return not self.monitor.stop_event.is_set()
+
+        mock_wait.side_effect = wait_effect
+
+        with patch("os.close", wraps=os.close) as spy_close:
+            await self.monitor.monitor_loop(sensor_id)
+
+        self.assertEqual(spy_close.call_count, 2)  # January, then February
+        dates = []
+        while not self.monitor.send_queue.empty():
+            dates.append(self.monitor.send_queue.get_nowait()[1][0])
+        self.assertEqual(dates, ["2023-01-31", "2023-02-01"])
+
+    @patch("govee_monitor.GoveeMonitor.wait_for_change", new_callable=AsyncMock)
+    async def test_monitor_loop_rollover_waits_for_new_file(self, mock_wait):
+        sensor_id = "LATE"
+        append = self.make_log_dir()
+        self.monitor.current_month = (2023, 1)
+        append(sensor_id, b"", month=(2023, 1))
+
+        # The month turns before the logger has created February's file, and
+        # a late January line still arrives in the meantime
+        def wait_effect(sensor_id):
+            if mock_wait.await_count == 1:
+                self.monitor.current_month = (2023, 2)
+            elif mock_wait.await_count == 2:
+                append(sensor_id, b"2023-01-31 23:59 20 50 100\n", month=(2023, 1))
+            elif mock_wait.await_count == 3:
+                append(sensor_id, b"", month=(2023, 2))
+            elif mock_wait.await_count == 4:
+                append(sensor_id, b"2023-02-01 00:00 21 50 100\n", month=(2023, 2))
+            else:
                 self.monitor.stop()
-            if original_sleep:
-                original_sleep(x)
+            return not self.monitor.stop_event.is_set()
+
+        mock_wait.side_effect = wait_effect
+
+        with patch.object(
+            self.monitor, "get_log_filename", wraps=self.monitor.get_log_filename
+        ) as spy_name:
+            await self.monitor.monitor_loop(sensor_id)
+
+        # Once at startup, once when the month turned (append passes 'now')
+        own_calls = [c for c in spy_name.call_args_list if "now" not in c.kwargs]
+        self.assertEqual(len(own_calls), 2)
+        dates = []
+        while not self.monitor.send_queue.empty():
+            dates.append(self.monitor.send_queue.get_nowait()[1][0])
+        self.assertEqual(dates, ["2023-01-31", "2023-02-01"])
+
+    @patch("govee_monitor.GoveeMonitor.sleep", new_callable=AsyncMock)
+    @patch("govee_monitor.utc_month")
+    async def test_month_clock_wakes_sensors_on_rollover(self, mock_month, mock_sleep):
+        self.monitor.current_month = (2023, 1)
+        self.monitor.file_events["S1"] = asyncio.Event()
+        self.monitor.month_check_interval = 60.0
+        # First wakeup is still January (e.g. an hourly re-check), then February
+        mock_month.side_effect = [(2023, 1), (2023, 2)]
+
+        def sleep_effect(seconds):
+            self.assertLessEqual(seconds, 60.0)
+            return mock_sleep.await_count <= 2  # stop() during the third
+
+        mock_sleep.side_effect = sleep_effect
+
+        await self.monitor.month_clock()
+
+        self.assertEqual(self.monitor.current_month, (2023, 2))
+        self.assertTrue(self.monitor.file_events["S1"].is_set())
+
+
+class TestMonthHelpers(unittest.TestCase):
+
+    def test_utc_month(self):
+        self.assertEqual(utc_month(datetime(2023, 5, 15)), (2023, 5))
+        self.assertEqual(len(utc_month()), 2)
+
+    def test_seconds_until_next_month(self):
+        now = datetime(2023, 1, 31, 23, 59, 30, tzinfo=timezone.utc)
+        self.assertEqual(seconds_until_next_month(now), 30.0)
+
+    def test_seconds_until_next_month_december(self):
+        now = datetime(2023, 12, 31, 0, 0, tzinfo=timezone.utc)
+        self.assertEqual(seconds_until_next_month(now), 86400.0)
+
+
+class TestSetupLogging(unittest.TestCase):
 
-        mock_sleep.side_effect = safety_wrapper
+    def test_records_reach_stderr_via_listener(self):
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        self.addCleanup(root.setLevel, level)
+        self.addCleanup(setattr, root, "handlers", handlers)
+        for name in ("watchfiles", "httpx"):
+            library = logging.getLogger(name)
+            self.addCleanup(library.setLevel, library.level)
 
-        self.monitor.monitor_loop(sensor_id)
+        stderr = io.StringIO()
+        with patch("sys.stderr", stderr):
+            listener = setup_logging()
+        # httpx logs each request at INFO; only our own line should get out
+        logging.getLogger("httpx").info('HTTP Request: POST http://x/log "200 OK"')
+        logging.getLogger("govee_monitor").info("Sent %s: %s", "S1", "now")
+        listener.stop()  # Flushes the queue
 
-        self.assertTrue(mock_file.return_value.close.called)
+        self.assertEqual(stderr.getvalue(), "INFO Sent S1: now\n")
 
 
 class TestLoadConfig(unittest.TestCase):
@@ -272,6 +734,7 @@ class TestLoadConfig(unittest.TestCase):
         self.assertEqual(config["log_dir"], DEFAULT_CONFIG["log_dir"])
         self.assertEqual(config["api_url"], DEFAULT_CONFIG["api_url"])
         self.assertIsNone(config["provision_key"])
+        self.assertEqual(config["dedupe_interval"], 300.0)
 
     def test_reads_overrides_from_file(self):
         body = (
@@ -279,6 +742,7 @@ class TestLoadConfig(unittest.TestCase):
             "log_dir = /tmp/custom\n"
             "api_url = http://localhost:8000/log\n"
             "provision_key = secret-key\n"
+            "dedupe_interval = 0\n"
         )
         with tempfile.NamedTemporaryFile("w", suffix=".ini", delete=False) as f:
             f.write(body)
@@ -288,6 +752,7 @@ class TestLoadConfig(unittest.TestCase):
             self.assertEqual(config["log_dir"], "/tmp/custom")
             self.assertEqual(config["api_url"], "http://localhost:8000/log")
             self.assertEqual(config["provision_key"], "secret-key")
+            self.assertEqual(config["dedupe_interval"], 0.0)
         finally:
             os.unlink(path)
 